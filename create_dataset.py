@@ -17,51 +17,81 @@ accordingly.
 import argparse
 import zipfile
 import os
+import re
 import shutil
 import tqdm
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 AREA_DIR = "area"
 POI_DIR = "poi"
 
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# archive members are named {geohash}.{band}.tif
+MEMBER_NAME_RE = re.compile(r"^[^.]+\.([^.]+)\.[^.]+$")
+
+# single digit sentinel bands are zero padded, other band names are left as is
+SENTINEL_BAND_NAMES = {f"B{i}": f"B0{i}" for i in range(1, 10)}
+
+
+def list_files(path):
+    # scandir returns the file type and inode with each entry, avoiding a stat call per
+    # file - entries are sorted by inode so reads follow the on-disk layout rather than
+    # the directory hash order
+    with os.scandir(path) as it:
+        entries = [e for e in it if e.is_file()]
+    return sorted(entries, key=lambda e: e.inode())
 
-def process_entries(download_location, entries, output_location):
-    for entry in tqdm.tqdm(entries):
-        try:
-            geohash, date = os.path.splitext(entry)[0].split("_")
-            with zipfile.ZipFile(
-                os.path.join(download_location, entry), "r"
-            ) as zip_ref:
-                zip_ref.extractall(temp_path)
-                temp_entries = os.listdir(temp_path)
-            for temp_entry in temp_entries:
-                # generate a new sentinel-like file name for the unzipped entry
-
-                # get the band into sentinel format, ignore the quality file
-                # 'B1' -> 'B01'
-                _, band, _ = temp_entry.split(".")
-                if band == "QA60":
-                    continue
-                if len(band) < 3:
-                    band = f"{band[0]}0{band[1]}"
-
-                # get the date into the sentinel format
-                # 20201112 -> 20201112T000000
-                year, month, day = date.split("-")
-                datestr = f"{year}{month}{day}T000000"
-
-                format_str = f"{geohash}_{datestr}_{band}.tif"
-
-                output_file = os.path.join(output_location, format_str)
-
-                # copy the file to the output dir using its new name
-                p = Path(output_file).parent
-                p.mkdir(parents=True, exist_ok=True)
-                shutil.copyfile(os.path.join(temp_path, temp_entry), output_file)
-        except:
-            continue
 
-        shutil.rmtree(temp_path)
+def band_members(zip_ref):
+    # returns the (member, band) pairs to be written out, with the band in sentinel
+    # format - the quality file is dropped from the listing so it is never decompressed
+    members = []
+    for info in zip_ref.infolist():
+        match = MEMBER_NAME_RE.match(info.filename)
+        if info.is_dir() or match is None:
+            continue
+        band = match.group(1)
+        if band == "QA60":
+            continue
+        # 'B1' -> 'B01'
+        members.append((info, SENTINEL_BAND_NAMES.get(band, band)))
+    return members
+
+
+def process_entry(entry, output_location):
+    geohash, date = os.path.splitext(entry.name)[0].split("_")
+
+    # get the date into the sentinel format
+    # 20201112 -> 20201112T000000
+    year, month, day = date.split("-")
+    # the output path prefix is shared by every band in the archive
+    prefix = os.path.join(output_location, f"{geohash}_{year}{month}{day}T000000_")
+
+    # bands are streamed straight from the archive to their final location, rather than
+    # being extracted to a temp dir and copied
+    with zipfile.ZipFile(entry.path, "r") as zip_ref:
+        for info, band in band_members(zip_ref):
+            # generate a new sentinel-like file name for the zipped entry
+            output_file = f"{prefix}{band}.tif"
+
+            # write the band to the output dir using its new name
+            with zip_ref.open(info) as src, open(output_file, "wb") as dst:
+                shutil.copyfileobj(src, dst, length=COPY_BUFFER_SIZE)
+
+
+def process_entries(entries, output_location, n_jobs):
+    # entries are independent and dominated by blocking I/O, so they are spread over a
+    # thread pool
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [
+            executor.submit(process_entry, entry, output_location) for entry in entries
+        ]
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except:
+                continue
 
 
 def parse_args():
@@ -75,29 +105,26 @@ def parse_args():
     parser.add_argument("--negative_label", type=str, default="negative")
     parser.add_argument("--flatten", default=False, action="store_true")
     parser.add_argument("--keep_metadata", default=True, action="store_false")
+    parser.add_argument(
+        "--n_jobs", type=int, default=min(32, (os.cpu_count() or 1) * 4)
+    )
 
     return parser.parse_args()
 
 
 args = parse_args()
 
-# create temp dir in the output dir
-temp_path = os.path.join(args.output_location, "temp")
-os.makedirs(temp_path, exist_ok=True)
-
-# read zip file and save geohash, time
-entries = os.listdir(args.download_location)
-
 # write to pos/neg folders
-if POI_DIR in entries:
+if os.path.isdir(os.path.join(args.download_location, POI_DIR)):
     poi_path = os.path.join(args.download_location, POI_DIR)
     poi_output_path = (
         os.path.join(args.output_location, args.positive_label)
         if not args.flatten
         else args.output_location
     )
-    poi_entries = os.listdir(poi_path)
-    process_entries(poi_path, poi_entries, poi_output_path)
+    os.makedirs(poi_output_path, exist_ok=True)
+    poi_entries = list_files(poi_path)
+    process_entries(poi_entries, poi_output_path, args.n_jobs)
 
 area_path = os.path.join(args.download_location, AREA_DIR)
 
@@ -106,8 +133,9 @@ area_output_path = (
     if not args.flatten
     else args.output_location
 )
-area_entries = os.listdir(area_path)
-process_entries(area_path, area_entries, area_output_path)
+os.makedirs(area_output_path, exist_ok=True)
+area_entries = list_files(area_path)
+process_entries(area_entries, area_output_path, args.n_jobs)
 
 
 # copy over metadata file
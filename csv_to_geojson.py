@@ -1,8 +1,7 @@
 import pandas as pd
-import geojson
+import orjson
 import argparse
 from pathlib import Path
-from shapely.geometry import Point
 
 
 def parse_args():
@@ -22,21 +21,25 @@ args = parse_args()
 
 features_df = pd.read_csv(args.features_csv)
 
-cols = [args.longitude_col, args.latitude_col, args.date_col]
-samples = features_df[cols]
-all_points = [(Point(x[0], x[1]), x[2]) for x in samples.values.tolist()]
-
-geojson_points = []
-for point in all_points:
-    geojson_point = geojson.Feature(
-        geometry=geojson.Point((point[0].x, point[0].y)),
-        properties={"date": point[1]},
-    )
-    geojson_points.append(geojson_point)
-
-geojson_points = geojson.FeatureCollection(geojson_points)
+# build the feature dicts directly from the column values rather than going through
+# intermediate shapely / geojson objects
+longitudes = features_df[args.longitude_col].tolist()
+latitudes = features_df[args.latitude_col].tolist()
+dates = features_df[args.date_col].tolist()
+
+geojson_points = {
+    "type": "FeatureCollection",
+    "features": [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": {"date": date},
+        }
+        for lon, lat, date in zip(longitudes, latitudes, dates)
+    ],
+}
 
 p = Path(args.output_file).parent
 p.mkdir(parents=True, exist_ok=True)
-with open(args.output_file, "w") as outfile:
-    geojson.dump(geojson_points, outfile, indent=2)
+with open(args.output_file, "wb") as outfile:
+    outfile.write(orjson.dumps(geojson_points, option=orjson.OPT_INDENT_2))
@@ -1,10 +1,8 @@
 import argparse
-import json
+import functools
 import os
-import random
 from joblib import Parallel, delayed
 from tqdm import tqdm
-import ee
 import helpers
 from pathlib import Path
 from datetime import datetime
@@ -32,7 +30,7 @@ def parse_args():
     parser.add_argument("--start_date", type=str, default="2020-01-01")
     parser.add_argument("--end_date", type=str, default=datetime.today().strftime("%Y-%m-%d")) # today's date
     parser.add_argument("--interval", type=int, default=30)
-    parser.add_argument("--n_jobs", type=int, default=30)
+    parser.add_argument("--n_jobs", type=int, default=64)
     parser.add_argument("--sampling", type=float, default=1.0)
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument(
@@ -42,14 +40,22 @@ def parse_args():
         "--skip_fetch", dest="skip_fetch", default=False, action="store_true"
     )
     parser.add_argument("--fetch_latest", dest="fetch_latest", default=False, action="store_true")
+    parser.add_argument("--export_bucket", type=str, default="")
+    parser.add_argument(
+        "--high_volume", dest="high_volume", default=False, action="store_true"
+    )
+    parser.add_argument("--num_shards", type=int, default=1)
+    parser.add_argument("--shard", type=int, default=0)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.num_shards < 1:
+        parser.error("--num_shards must be at least 1")
+    if not 0 <= args.shard < args.num_shards:
+        parser.error(f"--shard must be in the range [0, {args.num_shards})")
+    return args
 
 
 def main():
-    # initialize earth engine
-    ee.Initialize()
-
     args = parse_args()
 
     # for now we define bands by collection, but this can be made more general by supplying
@@ -71,17 +77,19 @@ def main():
 
     if args.input_file:
         # loads previously saved requests
-        input_json = json.load(open(args.input_file))
+        input_json = helpers.load_json(args.input_file)
         requests = input_json
 
     else:
         # loading coverage polygon from geo json file
         is_geo_json = True
-        coverage_geojson = json.load(open(args.coverage_file))
+        coverage_geojson = helpers.load_json(args.coverage_file)
 
         # generate geohashes covered by the AoI
         geohashes_aoi = helpers.geohashes_from_geojson_poly(
-            coverage_geojson, args.precision
+            coverage_geojson,
+            args.precision,
+            cache_dir=os.path.join(args.outdir, helpers.GEOHASH_CACHE_DIR),
         )
 
         # generate geohash + intervals, applying sampling
@@ -96,16 +104,17 @@ def main():
 
         if args.poi_file is not None and args.poi_file is not "":
             # load points of interest from geo json file
-            poi_geojson = json.load(open(args.poi_file))
+            poi_features = helpers.geojson_features(args.poi_file)
 
             # generate the geohashes containing each PoI, clipped geospatially and
             # temporally to the AoI and time bounds
             geohashes_poi = helpers.geohashes_from_geojson_points(
                 geohashes_aoi,
-                poi_geojson,
+                poi_features,
                 args.start_date,
                 args.end_date,
                 args.precision,
+                bounds=helpers.geojson_poly_bounds(coverage_geojson),
             )
 
             # merge the AoI geohash samples with the PoI data
@@ -126,33 +135,102 @@ def main():
                 }
             )
 
-    # save the metadata associated with the collection and bands we are fetching
-    helpers.fetch_metadata(args.outdir, collection, bands)
-
     Path(os.path.join(args.outdir, AREA_DIR)).mkdir(parents=True, exist_ok=True)
     Path(os.path.join(args.outdir, POI_DIR)).mkdir(parents=True, exist_ok=True)
 
     # save fetched tile info to json if required
     if args.save_requests and is_geo_json:
         output_path = os.path.join(args.outdir, "requests.json")
-        with open(output_path, "w+") as json_file:
-            json.dump(requests, json_file, indent=4)
+        helpers.dump_json_records(requests, output_path)
+
+    if args.skip_fetch:
+        # request generation doesn't start earth engine, so the metadata is only written
+        # if an earlier fetch cached it
+        if not helpers.fetch_metadata(args.outdir, collection, bands, cached_only=True):
+            print("collection metadata not cached - metadata.json is written on fetch")
 
     # Run jobs in parallel
     if not args.skip_fetch:
-        jobs = []
-        for request in requests:
-            # generate target path based on POI presence
-            subdir = POI_DIR if request["poi"] else AREA_DIR
-            outdir = os.path.join(args.outdir, subdir)
+        # initialize earth engine once - the fetch workers are threads, so they share
+        # this client and its credentials rather than re-authenticating per worker.  It
+        # is only loaded when fetching, as request generation doesn't need it.
+        import ee
+
+        if args.high_volume:
+            ee.Initialize(opt_url=helpers.EE_HIGH_VOLUME_URL)
+        else:
+            ee.Initialize()
+
+        # save the metadata associated with the collection and bands we are fetching
+        helpers.fetch_metadata(args.outdir, collection, bands)
+
+        # target path based on POI presence
+        outdirs = {
+            True: os.path.join(args.outdir, POI_DIR),
+            False: os.path.join(args.outdir, AREA_DIR),
+        }
+
+        # skip requests that already have a tile on disk from a previous run
+        existing_tiles = {
+            poi: helpers.list_fetched_tiles(outdir) for poi, outdir in outdirs.items()
+        }
+        pending_requests = [
+            r for r in requests if not helpers.is_fetched(r, existing_tiles[r["poi"]])
+        ]
+        print(
+            f"skipping previously fetched tile requests: {len(requests) - len(pending_requests)}"
+        )
 
-            job = delayed(helpers.fetch_tile)(request, outdir, collection, bands)
-            jobs.append(job)
+        # group the requests by geohash so that each job handles all the intervals
+        # for a single cell
+        requests_by_geohash = {}
+        for request in pending_requests:
+            requests_by_geohash.setdefault(request["geohash"], []).append(request)
+
+        # when the fetch is split across processes, only fetch this process's shard of
+        # the cells
+        if args.num_shards > 1:
+            requests_by_geohash = {
+                gh: gh_requests
+                for gh, gh_requests in requests_by_geohash.items()
+                if helpers.geohash_shard(gh, args.num_shards) == args.shard
+            }
+            print(
+                f"fetching shard {args.shard} of {args.num_shards}: {len(requests_by_geohash)} cells"
+            )
+
+        # schedule the cells in geohash order, shuffled within blocks of the worker count,
+        # so that the jobs in flight at any time fall in the same region
+        geohashes = helpers.block_shuffle_geohashes(
+            requests_by_geohash.keys(), args.n_jobs, args.seed
+        )
 
-        random.Random(args.seed).shuffle(jobs)
+        # the collection is filtered to the bands and overall date range of the pending
+        # requests once, and shared by every tile query
+        base_collection = helpers.prepare_collection(
+            collection,
+            bands,
+            min((r["date_start"] for r in pending_requests), default=None),
+            max((r["date_end"] for r in pending_requests), default=None),
+        )
+
+        # the arguments shared by every job are bound once, leaving only the per-cell
+        # requests in each job's payload
+        fetch = functools.partial(
+            helpers.fetch_tiles,
+            outdirs=outdirs,
+            collection=collection,
+            base_collection=base_collection,
+            bucket=args.export_bucket,
+        )
+        jobs = [delayed(fetch)(requests_by_geohash[gh]) for gh in geohashes]
 
+        # fetching is bound on network I/O with the GIL released, so threads avoid the
+        # fork and pickling overhead of worker processes and can exceed the core count.
+        # Job durations vary widely, so joblib is left to size the batches from the
+        # observed completion times.
         _ = Parallel(
-            backend="multiprocessing", n_jobs=args.n_jobs, verbose=1, batch_size=4
+            backend="threading", n_jobs=args.n_jobs, verbose=1, batch_size="auto"
         )(tqdm(jobs))
 
 
@@ -4,108 +4,214 @@ from https://github.com/cfld/locusts/, with a small amount of cleanup done.
 """
 
 import os
-from ee import image
+import re
+import functools
+import hashlib
+import shutil
 from shapely import geometry
-from itertools import product
+from shapely.prepared import prep
+from itertools import chain, product
 import geohash
+import numpy as np
 from polygon_geohasher.polygon_geohasher import (
     polygon_to_geohashes,
-    geohashes_to_polygon,
+    geohash_to_polygon,
 )
 from datetime import date, timedelta
 from dateutil.parser import parse
-import ee
-import backoff
 import random
-import urllib
-from urllib.request import urlretrieve
-import json
+import backoff
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import math
-import pathlib
 import zipfile
+import zlib
 import io
 from tifffile import imread
 
+# the Earth Engine client is slow to import, so it is imported by the functions that
+# call it - generating requests without fetching never loads it
+
+# The geohash base32 alphabet, indexed by digit value
+GEOHASH_CHARACTERS = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Lookup tables between geohash digit values and their ASCII character codes
+GEOHASH_DIGIT_CHARS = np.frombuffer(GEOHASH_CHARACTERS.encode("ascii"), dtype=np.uint8)
+GEOHASH_CHAR_DIGITS = np.zeros(256, dtype=np.uint64)
+GEOHASH_CHAR_DIGITS[GEOHASH_DIGIT_CHARS] = np.arange(32, dtype=np.uint64)
+
+
+# Number of levels above the target precision at which a coverage polygon is first
+# geohashed before being refined
+COARSE_PRECISION_STEP = 2
+
+# Maximum number of geohashes a coverage polygon may cover, guarding against precision /
+# AoI combinations that would exhaust memory
+MAX_AOI_GEOHASHES = 10_000_000
+
+
+# Loads a JSON / GeoJSON file, closing the handle once parsed
+def load_json(path):
+    with open(path, "rb") as json_file:
+        return orjson.loads(json_file.read())
+
+
+# Writes an object out as indented JSON.  The file is written under a temporary name and
+# moved into place once complete, so an interrupted write never leaves a truncated file
+# at the path.
+def dump_json(obj, path):
+    part_path = path + ".part"
+    with open(part_path, "wb") as json_file:
+        json_file.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    os.replace(part_path, path)
+
+
+# Writes an iterable of records out as a JSON list, serializing one record at a time so
+# the full document is never held in memory
+def dump_json_records(records, path):
+    with open(path, "wb") as json_file:
+        json_file.write(b"[")
+        for i, record in enumerate(records):
+            json_file.write(b",\n" if i else b"\n")
+            json_file.write(orjson.dumps(record))
+        json_file.write(b"\n]\n")
+
+
+# Returns every suffix string of the given length, used to enumerate all children of a
+# geohash at a finer precision
+@functools.lru_cache(maxsize=None)
+def _geohash_suffixes(length):
+    return ["".join(s) for s in product(GEOHASH_CHARACTERS, repeat=length)]
 
-from shapely.geometry import geo
-
-GEOHASH_CHARACTERS = [
-    "0",
-    "1",
-    "2",
-    "3",
-    "4",
-    "5",
-    "6",
-    "7",
-    "8",
-    "9",
-    "b",
-    "c",
-    "d",
-    "e",
-    "f",
-    "g",
-    "h",
-    "j",
-    "k",
-    "m",
-    "n",
-    "p",
-    "q",
-    "r",
-    "s",
-    "t",
-    "u",
-    "v",
-    "w",
-    "x",
-    "y",
-    "z",
-]
 
+# Refines a geohash down to the target precision against a prepared polygon.  Cells fully
+# inside the polygon contribute all of their children without further testing, cells
+# outside are dropped, and only cells on the boundary are subdivided and tested again.
+# Geohashes are yielded as they are found rather than collected into intermediate lists.
+def _refine_geohash(prepared_polygon, gh, precision, inner):
+    cell = geohash_to_polygon(gh)
+    if prepared_polygon.contains(cell):
+        yield from (gh + s for s in _geohash_suffixes(precision - len(gh)))
+        return
+    if not prepared_polygon.intersects(cell):
+        return
+    if len(gh) >= precision:
+        if not inner:
+            yield gh
+        return
+
+    for c in GEOHASH_CHARACTERS:
+        yield from _refine_geohash(prepared_polygon, gh + c, precision, inner)
 
-# Converts a polygon into a list of intersected / contained geohashes
-def poly_to_geohashes(polygon, precision=6, coarse_precision=None, inner=True):
+
+# Passes geohashes through, raising an error as soon as more than max_hashes are seen
+def _limit_geohashes(geohashes, max_hashes):
+    for count, gh in enumerate(geohashes, 1):
+        if count > max_hashes:
+            raise ValueError(f"polygon covers more than {max_hashes} geohashes")
+        yield gh
+
+
+# Converts a polygon into a list of intersected / contained geohashes.  When a coarse
+# precision is supplied the polygon is first covered at that precision, and each coarse
+# cell is then refined to the target precision.  If max_hashes is supplied, polygons
+# covering more geohashes than that fail with a ValueError before the full cover is
+# built.
+def poly_to_geohashes(
+    polygon, precision=6, coarse_precision=None, inner=True, max_hashes=None
+):
     polygon = geometry.shape(polygon)
-    if coarse_precision is None:
+    if coarse_precision is None or coarse_precision >= precision:
         geohashes = polygon_to_geohashes(polygon, precision=precision, inner=inner)
     else:
-        geohashes = polygon_to_geohashes(
-            polygon, precision=coarse_precision, inner=inner
+        prepared_polygon = prep(polygon)
+        geohashes = chain.from_iterable(
+            _refine_geohash(prepared_polygon, gh, precision, inner)
+            for gh in polygon_to_geohashes(
+                polygon, precision=coarse_precision, inner=False
+            )
         )
+    if max_hashes is not None:
+        geohashes = _limit_geohashes(geohashes, max_hashes)
+
+    return sorted(geohashes)
 
-        curr_precision = coarse_precision
-        while curr_precision < precision:
-            geohashes = [a + b for a, b in product(geohashes, GEOHASH_CHARACTERS)]
-            curr_precision += 1
 
-    return sorted(list(geohashes))
+# Converts a geohash into its representative bounding box expressed as Earth Engine
+# geometry.  A geohash decodes to an axis aligned box, so the rectangle is built directly
+# from its bounds.  Cells are cached, as the same geohash is requested for each of its
+# intervals.
+@functools.lru_cache(maxsize=100_000)
+def geohash_to_cell(h):
+    import ee
+
+    lat, lon, lat_d, lon_d = geohash.decode_exactly(h)
+    return ee.Geometry.Rectangle(
+        [lon - lon_d, lat - lat_d, lon + lon_d, lat + lat_d],
+        proj="EPSG:4326",
+        geodesic=False,
+    )
 
 
 # Converts a list of geohashes into their representative bounding boxes expressed
-# as Earth Engine geometry
+# as Earth Engine geometry.
 def geohashes_to_cells(geohashes):
-    cells = [geohashes_to_polygon([h]) for h in geohashes]
-    cells = [ee.Geometry(geometry.mapping(c)) for c in cells]
-    return cells
+    return [geohash_to_cell(h) for h in geohashes]
 
 
-# Generates a set of geohashes that are covered by a geojson polygon
-def geohashes_from_geojson_poly(coverage_geojson, precision):
+# Generates a set of geohashes that are covered by a geojson polygon.  If a cache dir is
+# supplied the result is cached there, keyed by the polygon geometry and precision, so
+# that re-runs over the same AoI skip the geohash computation.
+def geohashes_from_geojson_poly(coverage_geojson, precision, cache_dir=None):
     # TODO: better validation
     assert coverage_geojson["type"] == "FeatureCollection"
     polygon = coverage_geojson["features"][0]
     assert polygon["type"] == "Feature"
     assert polygon["geometry"]["type"] == "Polygon"
 
-    # determine geohashes that overlap our AoI
+    if cache_dir is not None:
+        cache_key = hashlib.sha1(
+            geometry.shape(polygon["geometry"]).wkb + f"|{precision}".encode()
+        ).hexdigest()
+        cache_path = os.path.join(cache_dir, f"{cache_key}.json")
+        # an unreadable entry (e.g. truncated by an interrupted write) is recomputed
+        if os.path.exists(cache_path):
+            try:
+                return load_json(cache_path)
+            except orjson.JSONDecodeError:
+                pass
+
+    # determine geohashes that overlap our AoI, refining from a coarser grid so that
+    # cells in the interior of the polygon don't need to be tested individually
     geohashes_aoi = poly_to_geohashes(
-        polygon["geometry"], precision=precision, coarse_precision=precision
+        polygon["geometry"],
+        precision=precision,
+        coarse_precision=max(1, precision - COARSE_PRECISION_STEP),
+        max_hashes=MAX_AOI_GEOHASHES,
     )
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        dump_json(geohashes_aoi, cache_path)
     return geohashes_aoi
 
 
+# Returns the (min lon, min lat, max lon, max lat) bounds of a geojson coverage polygon.
+# The AoI geohashes lie within the polygon, so any point in them lies within these bounds.
+def geojson_poly_bounds(coverage_geojson):
+    return geometry.shape(coverage_geojson["features"][0]["geometry"]).bounds
+
+
+# Returns the (lon, lat) size of a geohash cell at the given precision.  The size is fixed
+# for a precision, so it is cached for callers that look it up per segment or cell.
+@functools.lru_cache(maxsize=None)
+def geohash_cell_size(precision):
+    bounds = geohash.bbox("0" * precision)
+    return (bounds["e"] - bounds["w"], bounds["n"] - bounds["s"])
+
+
 def geohash_to_array_str(geohash_str):
     # return geohash as a flat list with alternating X,Y values, starting
     # at LL and moving CW
@@ -114,39 +220,144 @@ def geohash_to_array_str(geohash_str):
     return bounds
 
 
-# Generates a set of geohashes that are covered by a geojson polygon
-def geohashes_from_geojson_points(
-    geohashes_aoi, points_geojson, start_date, end_date, precision
-):
-    assert points_geojson["type"] == "FeatureCollection"
-    points = points_geojson["features"]
+# Spreads the low 32 bits of each value out to the even bit positions of a 64 bit value
+def _spread_bits(x):
+    x = x & np.uint64(0x00000000FFFFFFFF)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x3333333333333333)
+    x = (x | (x << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return x
+
+
+# Encodes arrays of lat / lon values as integer geohash codes of the given precision (max
+# 12).  Lat and lon are quantized to 32 bits and interleaved (lon first, as per the
+# geohash spec) into a 64 bit morton code, the top 5 * precision bits of which are the
+# geohash digits.
+def encode_geohash_codes(lats, lons, precision):
+    scale = float(1 << 32)
+    max_cell = np.uint64((1 << 32) - 1)
+    lat_cells = np.minimum(
+        ((np.asarray(lats, dtype=np.float64) + 90.0) / 180.0 * scale).astype(np.uint64),
+        max_cell,
+    )
+    lon_cells = np.minimum(
+        ((np.asarray(lons, dtype=np.float64) + 180.0) / 360.0 * scale).astype(np.uint64),
+        max_cell,
+    )
+    codes = (_spread_bits(lon_cells) << np.uint64(1)) | _spread_bits(lat_cells)
+    return codes >> np.uint64(64 - 5 * precision)
 
-    start_iso = date.fromisoformat(start_date)
-    end_iso = date.fromisoformat(end_date)
 
-    # loop through the points of interest and clip each to the geographic and temporal bounds -  we save a list
-    # a list of dates per hash since different points could map to the same bucket at different points
-    # in time
-    geohash_points = {}
-    for point in points:
-        point_iso = parse(point["properties"]["date"]).date()
+# Converts an array of integer geohash codes to geohash strings of the given precision
+def geohash_codes_to_strings(codes, precision):
+    # split the code into base32 digits and map them to characters
+    shifts = np.arange(5 * (precision - 1), -1, -5, dtype=np.uint64)
+    digits = (np.asarray(codes, dtype=np.uint64)[:, None] >> shifts[None, :]) & np.uint64(
+        31
+    )
+    # each row of character codes is reinterpreted as a single fixed width string
+    chars = np.ascontiguousarray(GEOHASH_DIGIT_CHARS[digits.astype(np.intp)])
+    return chars.view(f"S{precision}").ravel().astype(f"U{precision}").tolist()
 
-        if point_iso >= start_iso and point_iso <= end_iso:
-            assert point["type"] == "Feature"
-            assert point["geometry"]["type"] == "Point"
-            assert point["properties"] is not None
-            assert point["properties"]["date"] is not None
-            coords = point["geometry"]["coordinates"]
 
-            gh = geohash.encode(coords[1], coords[0], precision=precision)
-            if gh not in geohashes_aoi:
-                continue
+# Converts geohash strings of the given precision to integer geohash codes
+def geohash_strings_to_codes(geohashes, precision):
+    chars = np.array(list(geohashes), dtype=f"S{precision}").view(np.uint8)
+    digits = GEOHASH_CHAR_DIGITS[chars.reshape(-1, precision)]
+    codes = np.zeros(len(digits), dtype=np.uint64)
+    for i in range(precision):
+        codes = (codes << np.uint64(5)) | digits[:, i]
+    return codes
+
+
+# Encodes arrays of lat / lon values as geohashes of the given precision (max 12)
+def encode_geohashes(lats, lons, precision):
+    return geohash_codes_to_strings(
+        encode_geohash_codes(lats, lons, precision), precision
+    )
+
+
+# Yields the features of a geojson feature collection file
+def geojson_features(path):
+    features_geojson = load_json(path)
+    assert features_geojson["type"] == "FeatureCollection"
+    yield from features_geojson["features"]
+
+
+# Parses a date string, using the fast ISO 8601 parser where possible and falling back to
+# dateutil for other formats.  Point data tends to repeat dates, so results are cached.
+@functools.lru_cache(maxsize=100_000)
+def parse_date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return parse(value).date()
 
-            if gh not in geohash_points:
-                geohash_points[gh] = []
-            geohash_points[gh].append(point_iso)
 
-    return geohash_points
+# Generates a set of geohashes that are covered by an iterable of geojson point features.
+# If the (min lon, min lat, max lon, max lat) bounds of the AoI are supplied, points
+# outside of them are dropped before any geohashes are computed.
+def geohashes_from_geojson_points(
+    geohashes_aoi, points, start_date, end_date, precision, bounds=None
+):
+    point_dates = []
+    coords = []
+    for point in points:
+        assert point["type"] == "Feature"
+        assert point["geometry"]["type"] == "Point"
+        assert point["properties"] is not None
+        assert point["properties"]["date"] is not None
+        point_dates.append(parse_date(point["properties"]["date"]))
+        coords.append(point["geometry"]["coordinates"][:2])
+
+    if not coords:
+        return {}
+    point_dates = np.array(point_dates, dtype="datetime64[D]")
+    coords = np.asarray(coords, dtype=np.float64)
+
+    # clip each point of interest to the temporal bounds and the AoI bounding box, then
+    # encode the surviving points in a single vectorized pass
+    in_range = (point_dates >= np.datetime64(start_date, "D")) & (
+        point_dates <= np.datetime64(end_date, "D")
+    )
+    if bounds is not None:
+        min_lon, min_lat, max_lon, max_lat = bounds
+        in_range &= (
+            (coords[:, 0] >= min_lon)
+            & (coords[:, 0] <= max_lon)
+            & (coords[:, 1] >= min_lat)
+            & (coords[:, 1] <= max_lat)
+        )
+    point_dates = point_dates[in_range]
+    coords = coords[in_range]
+    point_codes = encode_geohash_codes(coords[:, 1], coords[:, 0], precision)
+
+    # clip to the geographic bounds - membership is tested on integer codes against the
+    # sorted AoI codes, and only the hashes that are kept are converted to strings
+    aoi_codes = np.sort(geohash_strings_to_codes(geohashes_aoi, precision))
+    if len(aoi_codes) == 0:
+        return {}
+    positions = np.minimum(np.searchsorted(aoi_codes, point_codes), len(aoi_codes) - 1)
+    in_aoi = aoi_codes[positions] == point_codes
+    point_codes = point_codes[in_aoi]
+    point_dates = point_dates[in_aoi]
+
+    # group the dates by hash - we save a list of dates per hash since different points
+    # could map to the same bucket at different points in time.  A stable sort keeps each
+    # hash's dates in their input order.
+    unique_codes, inverse = np.unique(point_codes, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    splits = np.cumsum(np.bincount(inverse, minlength=len(unique_codes)))[:-1]
+    grouped_dates = np.split(point_dates[order], splits)
+
+    return {
+        gh: dates.tolist()
+        for gh, dates in zip(
+            geohash_codes_to_strings(unique_codes, precision), grouped_dates
+        )
+    }
 
 
 # Generates tile fetch requests given an input coverage polygon,
@@ -161,33 +372,35 @@ def generate_fetch_requests(
     sampling_rate=1.0,
 ):      
     # determine time intervals
-    delta = date.fromisoformat(end_date) - date.fromisoformat(start_date)
-    intervals = []
+    start = date.fromisoformat(start_date)
+    delta = date.fromisoformat(end_date) - start
     if not fetch_latest:
-        for i in range(int(delta.days / interval_days)):
-            curr_start_date = date.fromisoformat(start_date) + timedelta(
-                days=i * interval_days
-            )
-            curr_end_date = curr_start_date + timedelta(days=interval_days)
-            intervals.append((curr_start_date, curr_end_date))
+        step = timedelta(days=interval_days)
+        starts = [start + step * i for i in range(delta.days // interval_days + 1)]
+        intervals = list(zip(starts[:-1], starts[1:]))
     else:
         intervals = [(start_date, end_date)]
 
+    # randomly sample the request set - only the indices of the sampled requests are
+    # drawn, and each is split into its geohash and interval indices, so the full
+    # geohash x interval product is never materialized
+    num_requests = len(geohashes_aoi) * len(intervals)
+    subset_length = min(math.floor(num_requests * sampling_rate), num_requests)
+    if subset_length < num_requests:
+        indices = np.sort(
+            np.random.default_rng().choice(num_requests, subset_length, replace=False)
+        )
+    else:
+        indices = np.arange(num_requests)
+    gh_indices, interval_indices = np.divmod(indices, max(len(intervals), 1))
+
     # create a final tile list
-    tile_requests = []
-    for gh in geohashes_aoi:
-        for interval in intervals:
-            tile_requests.append((gh, False, interval))
-
-    # randomly sample the request set
-    random.shuffle(tile_requests)
-    subset_length = math.floor(len(tile_requests) * sampling_rate)
-    tile_requests_sampled = tile_requests[:subset_length]
-
-    unique_hashes = set()
-    for r in tile_requests_sampled:
-        unique_hashes.add(r[0])
-    print(f"unique background tiles: {len(unique_hashes)}")
+    tile_requests_sampled = [
+        (geohashes_aoi[g], False, intervals[i])
+        for g, i in zip(gh_indices.tolist(), interval_indices.tolist())
+    ]
+
+    print(f"unique background tiles: {len(np.unique(gh_indices))}")
     print(f"total background tile requests: {len(tile_requests_sampled)}")
 
     return tile_requests_sampled
@@ -197,25 +410,87 @@ def generate_fetch_requests(
 # geohash precision, optional points of interest, start and date, and
 # interval.
 def generate_fetch_requests_poi(fetch_requests_aoi, geohashes_poi, interval_days):
-    # Create records for each geohash and append them to the AoI list
-    start_len = len(fetch_requests_aoi)
-    fetch_requests = fetch_requests_aoi
+    # Create records for each geohash and merge them into the AoI list.  Requests are
+    # keyed by geohash and interval so that each tile is only fetched once, with a
+    # request flagged as a PoI if any of its duplicates are.
+    requests_by_key = {
+        (gh, interval): is_poi for gh, is_poi, interval in fetch_requests_aoi
+    }
+    step = timedelta(days=interval_days)
     for gh, dates in geohashes_poi.items():
         for d in dates:
-            end = d + timedelta(days=interval_days)
-            fetch_requests.append((gh, True, (d, end)))
+            requests_by_key[(gh, (d, d + step))] = True
+    fetch_requests = [
+        (gh, is_poi, interval) for (gh, interval), is_poi in requests_by_key.items()
+    ]
 
-    print(f"total poi requests: {len(fetch_requests) - start_len}")
+    print(f"total poi requests: {sum(r[1] for r in fetch_requests)}")
     print(f"total tile requests (poi + background): {len(fetch_requests)}")
 
     return fetch_requests
 
 
+# Returns the shard a geohash is assigned to when the fetch is split across several
+# processes.  A stable hash is used so that every process agrees on the assignment.
+def geohash_shard(gh, num_shards):
+    return zlib.crc32(gh.encode()) % num_shards
+
+
+# Orders geohashes for fetching.  The hashes are sorted (which follows a z-order curve,
+# keeping neighbouring cells together) and then shuffled only within fixed size blocks,
+# retaining coarse spatial locality while still mixing up the order of the jobs being
+# worked on at the same time.
+def block_shuffle_geohashes(geohashes, block_size, seed=None):
+    geohashes = sorted(geohashes)
+    rng = random.Random(seed)
+    block_size = max(block_size, 1)
+    for i in range(0, len(geohashes), block_size):
+        block = geohashes[i : i + block_size]
+        rng.shuffle(block)
+        geohashes[i : i + block_size] = block
+    return geohashes
+
+
 # Earth Engine collection info.
 
 # Sentinel collection name
 SENTINEL_2_COLLECTION = "COPERNICUS/S2"
 
+# Directory under the fetch output dir used to cache collection metadata
+METADATA_CACHE_DIR = ".meta_cache"
+
+# Directory under the fetch output dir used to cache the geohashes covering an AoI
+GEOHASH_CACHE_DIR = ".geohash_cache"
+
+# Buffer size used when streaming downloaded tiles to disk
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Number of pooled download connections - matches the default fetch worker count so that
+# concurrent downloads don't discard connections from an undersized pool
+DOWNLOAD_POOL_SIZE = 64
+
+# Seconds to wait on a stalled tile download before giving up on it
+DOWNLOAD_TIMEOUT = 120
+
+# Maximum number of images considered per request when searching for a valid tile
+MAX_CANDIDATE_IMAGES = 200
+
+# Earth Engine endpoint intended for large numbers of concurrent automated requests
+EE_HIGH_VOLUME_URL = "https://earthengine-highvolume.googleapis.com"
+
+# Maximum attempts for an Earth Engine request that fails with a (typically rate limit)
+# error
+EE_MAX_TRIES = 6
+
+# Earth Engine errors that clear on retry - rate limits, timeouts and server side
+# failures.  Anything else (an oversized request, an invalid band) fails the same way
+# every time.
+EE_TRANSIENT_ERROR_RE = re.compile(
+    r"too many (concurrent|requests)|rate limit|quota|timed out|deadline exceeded"
+    r"|internal error|backend error|service unavailable|\b(429|5\d\d)\b",
+    re.IGNORECASE,
+)
+
 MIN_DS_DATE = {
     "COPERNICUS/S2": '2015-06-23'
 }
@@ -237,107 +512,333 @@ SENTINEL_2_CHANNELS = [
     "QA60",
 ]
 
-# Generates an image
+# Generates an image with cloud and cirrus pixels masked out, testing both QA60 bits in
+# a single pass
 def mask_s2_clouds(image):
     qa = image.select("QA60")
 
     cloudBitMask = 1 << 10
     cirrusBitMask = 1 << 11
 
-    mask = qa.bitwiseAnd(cloudBitMask).eq(0)
-    mask = mask.bitwiseAnd(cirrusBitMask).eq(0)
+    mask = qa.bitwiseAnd(cloudBitMask | cirrusBitMask).eq(0)
 
     return image.updateMask(mask)
 
-# Write the metadata from the first tile in the collection out
-def fetch_metadata(outdir, collection, bands):
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
+# Write the metadata from the first tile in the collection out.  The metadata is constant
+# for a given collection and band set, so it is cached under the output dir and the
+# Earth Engine request is skipped on subsequent runs.  If cached_only is set the metadata
+# is only written when it is already cached, so Earth Engine is never used - returns
+# whether it was written.
+def fetch_metadata(outdir, collection, bands, cached_only=False):
+    cache_dir = os.path.join(outdir, METADATA_CACHE_DIR)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
 
     outpath = os.path.join(outdir, "metadata.json")
-    dataset = ee.ImageCollection(collection).select(bands)
+    cache_key = hashlib.sha1(
+        (collection + "|" + ",".join(sorted(bands))).encode()
+    ).hexdigest()
+    cache_path = os.path.join(cache_dir, f"{cache_key}.json")
 
-    example_tile_info = dataset.toList(1).get(0).getInfo()
+    if not os.path.exists(cache_path):
+        if cached_only:
+            return False
 
-    with open(outpath, "w") as outfile:
-        json.dump(example_tile_info, outfile, indent=4)
-    return
+        import ee
 
+        dataset = ee.ImageCollection(collection).select(bands)
 
-# Fetches data from a URL with support for retries
-@backoff.on_exception(backoff.constant, urllib.error.HTTPError, max_tries=4, interval=2)
-def safe_urlretrieve(url, outpath):
-    _ = urlretrieve(url, outpath)
+        example_tile_info = dataset.toList(1).get(0).getInfo()
+
+        dump_json(example_tile_info, cache_path)
+
+    shutil.copyfile(cache_path, outpath)
+    return True
+
+
+# Shared HTTP session so that connections (and their TLS sessions) are pooled and
+# reused across tile downloads, with failed requests retried by urllib3
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=DOWNLOAD_POOL_SIZE,
+        pool_maxsize=DOWNLOAD_POOL_SIZE,
+        max_retries=Retry(
+            total=4, backoff_factor=2, status_forcelist=[500, 502, 503, 504]
+        ),
+    ),
+)
 
-# loads tile returns false if image is all black
+
+# Returns true if an Earth Engine error won't clear on retry
+def is_permanent_ee_error(e):
+    return EE_TRANSIENT_ERROR_RE.search(str(e)) is None
+
+
+# Runs an Earth Engine request, retrying with exponential backoff on failure.  Under a
+# large number of concurrent requests EE rejects some with rate limit errors that clear
+# after a short wait - other errors are raised immediately.
+def ee_retry(fn, *args, **kwargs):
+    import ee
+
+    retrying_fn = backoff.on_exception(
+        backoff.expo,
+        ee.EEException,
+        max_tries=EE_MAX_TRIES,
+        giveup=is_permanent_ee_error,
+    )(fn)
+    return retrying_fn(*args, **kwargs)
+
+
+# Fetches data from a URL with support for retries, streaming the body to disk.  The body
+# is written to a temporary file that is only moved into place once complete, so an
+# interrupted download never leaves a partial file at the output path.
+def safe_urlretrieve(url, outpath):
+    part_path = outpath + ".part"
+    try:
+        with SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            # read the raw socket stream directly, decoding any transfer compression
+            response.raw.decode_content = True
+            with open(part_path, "wb") as outfile:
+                shutil.copyfileobj(response.raw, outfile, length=DOWNLOAD_CHUNK_SIZE)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, outpath)
+
+# loads tile returns false if image is all black - only the smallest band is decoded,
+# since a masked / empty image is black in every band.  The QA60 band is skipped as it is
+# legitimately all zero for cloud free images.  An archive that can't be read (corrupt,
+# truncated or without any bands) is also invalid.
 def is_valid_tile(file_path: str) -> bool:
-    archive = zipfile.ZipFile(file_path, 'r')
-    file_list = archive.namelist()
-    bytes = io.BytesIO(archive.read(file_list[0]))
-    img = imread(bytes)
-
-    return img.max() != 0
-# download_image is a recursion based function designed to pop the first image from the image collection if it does not pass validation and move onto the next
-# one thing to note is that this is the optimal approach currently when dealing with the earth engine api
-# converting the collection to a list locally does not scale and the api will refuse when dealing with 1000s
-# this function scales
-def download_image(image_collection: ee.ImageCollection, cell: ee.Geometry, output_dir: str, request) -> None:
-    # get size of collection if 0 there was no valid images in the collection for this geohash and constraints
-    size = image_collection.size().getInfo() 
-    if not size:
-        return
-    # get first image from collection
-    first_image = image_collection.first()
-    # get the meat info surrounding the image which is used later to remove if the image is bad
-    image_meta = first_image.getInfo()
-    # get the date and format it
-    image_date = first_image.date().format("yyyy-MM-dd").getInfo()
-    # output directory
-    tmp_outpath = output_dir + image_date + ".zip"    
-    # clip the desired image
-    clipped_image = first_image.clip(cell)
     try:
-        url = clipped_image.getDownloadURL(
-            params={"name": request["geohash"], "crs": "EPSG:4326", "scale": 10}
+        with zipfile.ZipFile(file_path, 'r') as archive:
+            members = [i for i in archive.infolist() if ".QA60." not in i.filename]
+            if not members:
+                print(f"no bands in tile {file_path}")
+                return False
+            smallest = min(members, key=lambda i: i.file_size)
+            bytes = io.BytesIO(archive.read(smallest))
+        img = imread(bytes)
+    except Exception as e:
+        # zip, deflate and tiff decoding each raise their own errors on bad data
+        print(f"unreadable tile {file_path}: {e}")
+        return False
+
+    return bool(img.any())
+
+
+# Builds the (unevaluated) list of candidate image ids and dates for a collection, so that
+# candidates for several collections can be resolved in a single request
+def candidate_images(image_collection):
+    import ee
+
+    candidates = image_collection.limit(MAX_CANDIDATE_IMAGES)
+    return ee.List(
+        [
+            candidates.aggregate_array("system:index"),
+            candidates.aggregate_array("system:time_start").map(
+                lambda t: ee.Date(t).format("yyyy-MM-dd")
+            ),
+        ]
+    )
+
+
+# download_image walks the image collection in order, downloading each image until one
+# passes validation.  The ids and dates of the candidate images are resolved together in
+# a single request up front, rather than issuing size / info / date requests per image
+# and re-filtering the collection each time an image is rejected.  Candidates that have
+# already been resolved can be passed in to skip that request.
+def download_image(image_collection: "ee.ImageCollection", cell: "ee.Geometry", output_dir: str, request, candidates=None) -> None:
+    import ee
+
+    if candidates is None:
+        candidates = ee_retry(candidate_images(image_collection).getInfo)
+    image_ids, image_dates = candidates
+    # if the lists are empty there were no valid images in the collection for this
+    # geohash and constraints
+    for image_id, image_date in zip(image_ids, image_dates):
+        # each candidate is selected from the base collection by id, so the filter chain
+        # stays the same size however many images are rejected
+        image = ee.Image(
+            image_collection.filter(ee.Filter.eq("system:index", image_id)).first()
         )
-        # download image
-        _ = safe_urlretrieve(url, tmp_outpath)
+        # output directory
+        tmp_outpath = output_dir + image_date + ".zip"
+        # the image has already been fetched, by an earlier run or an overlapping request
+        if os.path.exists(tmp_outpath) and os.path.getsize(tmp_outpath) > 0:
+            return
+        # clip the desired image
+        clipped_image = image.clip(cell)
+        try:
+            url = ee_retry(
+                clipped_image.getDownloadURL,
+                params={"name": request["geohash"], "crs": "EPSG:4326", "scale": 10},
+            )
+            # download image
+            _ = safe_urlretrieve(url, tmp_outpath)
+        except (ee.EEException, requests.RequestException) as e:
+            # a failed request would fail the same way for the other candidates, so the
+            # request is abandoned - nothing is left at the output path on failure
+            print(f"failed to fetch {request['geohash']} {image_date}: {e}")
+            return
         # valid tile for constraints and location move on
         if is_valid_tile(tmp_outpath):
             return
         # invalid tile clean up zip file and continue checking other images in collection
         os.remove(tmp_outpath)
-        # remove the image from the collection as it was bad and download the next image in the collection
-        download_image(image_collection.filter(ee.Filter.neq('system:index', image_meta["properties"]["system:index"])), cell, output_dir, request)
-    except:
-            pass
     return
 
-# Fetch a single tile given request info, collection and bands of interest
-def fetch_tile(request, outdir, collection, bands):
+# Builds the base collection shared by every tile fetched - the requested collection
+# filtered by the supplied bands and, if given, the overall date range of the requests.
+# It is built once so that each tile's query only adds its own location and dates.
+def prepare_collection(collection, bands, start_date=None, end_date=None):
+    import ee
+
+    base_collection = ee.ImageCollection(collection).select(bands)
+    if start_date is not None and end_date is not None:
+        base_collection = base_collection.filterDate(start_date, end_date)
+    # Apply additional cloud filtering for sentinel-2 tiles.
+    if collection == SENTINEL_2_COLLECTION:
+        base_collection = base_collection.filter(
+            ee.Filter.lt("CLOUDY_PIXEL_PERCENTAGE", 10)
+        )
+    return base_collection
+
+
+# Builds the bounding quad for a geohash, along with the base collection filtered to the
+# images that cover the quad.  Both are independent of the request dates, so they can be
+# shared by every request for the geohash.
+def cell_collection(gh, base_collection):
+    import ee
 
-    # Set tile output path to combo of geohash the date and extension is added later
-    outpath = os.path.join(
-        outdir, request["geohash"] + "_" 
-    )
     # get the bounding quad for the geohash
-    cell = geohashes_to_cells([request["geohash"]])[0]
-    # Filter the requested collection by the supplied bands and start/end dates
-    # for the request.
+    cell = geohash_to_cell(gh)
+    lat, lon, lat_d, lon_d = geohash.decode_exactly(gh)
     filtered_collection = (
-        ee.ImageCollection(collection)
-        .select(bands)
-        .filterDate(request["date_start"], request["date_end"])
-        .filterBounds(ee.Geometry.Point(cell._coordinates[0][0])) # filter by top left point of quad (note: this is an intersection filter)
-        .filterBounds(ee.Geometry.Point(cell._coordinates[0][2])) # filter by bottom right point of quad (note: this is an intersection filter)
-        .sort("system:time_start", False)
+        base_collection
+        .filterBounds(ee.Geometry.Point([lon - lon_d, lat + lat_d])) # filter by top left point of quad (note: this is an intersection filter)
+        .filterBounds(ee.Geometry.Point([lon + lon_d, lat - lat_d])) # filter by bottom right point of quad (note: this is an intersection filter)
         # the result of the two filterBounds is a tile the contains all of our quad
     )
-    # Apply additional cloud filtering for sentinel-2 tiles.
+    return cell, filtered_collection
+
+
+# Lists the tiles already downloaded to an output dir as a map of geohash to the image
+# dates fetched for it
+def list_fetched_tiles(outdir):
+    fetched = {}
+    with os.scandir(outdir) as it:
+        for entry in it:
+            name, ext = os.path.splitext(entry.name)
+            if ext != ".zip" or "_" not in name:
+                continue
+            gh, image_date = name.split("_", 1)
+            fetched.setdefault(gh, []).append(image_date)
+    return fetched
+
+
+# Tiles are saved under the date of the image that was found, so a request has been
+# fetched if any tile for its geohash falls within its (end exclusive) date range
+def is_fetched(request, fetched):
+    return any(
+        request["date_start"] <= image_date < request["date_end"]
+        for image_date in fetched.get(request["geohash"], ())
+    )
+
+
+# Filters a geohash's base collection down to the images for a single request, most
+# recent first
+def request_collection(request, collection, cell_images):
+    # Filter by the start/end dates for the request.
+    filtered_collection = cell_images.filterDate(
+        request["date_start"], request["date_end"]
+    ).sort("system:time_start", False)
     if collection == SENTINEL_2_COLLECTION:
-        filtered_collection = filtered_collection.filter(
-            ee.Filter.lt("CLOUDY_PIXEL_PERCENTAGE", 10)
-        ).map(
+        filtered_collection = filtered_collection.map(
             mask_s2_clouds, True
         )  # Apply cloud mask
-    download_image(filtered_collection, cell, outpath, request)
\ No newline at end of file
+    return filtered_collection
+
+
+# Fetch a single tile given request info, and the cell and filtered collection for its
+# geohash.  The output path is the combo of output dir and geohash - the date and
+# extension are added later.
+def fetch_cell_tile(request, outpath, collection, cell, cell_images):
+    filtered_collection = request_collection(request, collection, cell_images)
+    download_image(filtered_collection, cell, outpath, request)
+
+
+# Export a single tile to Cloud Storage rather than downloading it, so that Earth Engine
+# runs the exports as server side batch tasks that aren't subject to the per-user
+# download limits.  The most recent image for the request is exported as a GeoTIFF named
+# {prefix}/{geohash}_{date}.tif - as tiles aren't downloaded they can't be checked
+# for blackness.
+def export_cell_tile(request, prefix, collection, cell, cell_images, bucket):
+    import ee
+
+    filtered_collection = request_collection(request, collection, cell_images).limit(1)
+    image_dates = ee_retry(
+        filtered_collection.aggregate_array("system:time_start")
+        .map(lambda t: ee.Date(t).format("yyyy-MM-dd"))
+        .getInfo
+    )
+    if not image_dates:
+        return
+    name = f"{request['geohash']}_{image_dates[0]}"
+    task = ee.batch.Export.image.toCloudStorage(
+        image=ee.Image(filtered_collection.first()).clip(cell),
+        description=name,
+        bucket=bucket,
+        fileNamePrefix=f"{prefix}/{name}",
+        region=cell,
+        crs="EPSG:4326",
+        scale=10,
+        maxPixels=int(1e9),
+    )
+    ee_retry(task.start)
+
+
+# Fetch a single tile given request info, collection and bands of interest
+def fetch_tile(request, outdir, collection, bands):
+    base_collection = prepare_collection(collection, bands)
+    cell, cell_images = cell_collection(request["geohash"], base_collection)
+    outpath = os.path.join(outdir, request["geohash"] + "_")
+    fetch_cell_tile(request, outpath, collection, cell, cell_images)
+
+
+# Fetch all tiles for a list of requests sharing the same geohash, writing each to the
+# output dir keyed by its POI flag.  The cell geometry, the cell's view of the base
+# collection and the output paths are built once, and only the date filter is applied
+# per request.  The candidate images for every request are resolved in a single Earth
+# Engine request.  If a bucket is supplied the tiles are exported to it instead, using
+# the output dirs as path prefixes.
+def fetch_tiles(tile_requests, outdirs, collection, base_collection, bucket=None):
+    gh = tile_requests[0]["geohash"]
+    cell, cell_images = cell_collection(gh, base_collection)
+    if bucket:
+        for request in tile_requests:
+            export_cell_tile(
+                request, outdirs[request["poi"]], collection, cell, cell_images, bucket
+            )
+        return
+
+    import ee
+
+    outpaths = {poi: os.path.join(outdir, gh + "_") for poi, outdir in outdirs.items()}
+    filtered_collections = [
+        request_collection(request, collection, cell_images)
+        for request in tile_requests
+    ]
+    resolved_candidates = ee_retry(
+        ee.List([candidate_images(c) for c in filtered_collections]).getInfo
+    )
+    for request, filtered_collection, candidates in zip(
+        tile_requests, filtered_collections, resolved_candidates
+    ):
+        download_image(
+            filtered_collection, cell, outpaths[request["poi"]], request, candidates
+        )
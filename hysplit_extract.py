@@ -6,12 +6,21 @@ import pathlib
 import re
 from datetime import datetime
 import collections
+import numpy as np
 import pandas as pd
 import geohash
 import math
 import helpers
 import plotly.express as px
 
+# offset applied to (signed) grid cell indices when packing them into unsigned keys
+CELL_INDEX_OFFSET = 1 << 31
+
+# trajectory file columns - types are given up front so the parser doesn't have to infer
+# them for every day file
+TRAJECTORY_COLUMNS = ["point_id", "x", "y", "altitude"]
+TRAJECTORY_DTYPES = {"point_id": str, "x": float, "y": float, "altitude": float}
+
 ControlInfo = collections.namedtuple("ControlInfo", ["num_tracks", "date", "duration"])
 
 
@@ -45,9 +54,6 @@ def extract_input(input_dir, temp_dir):
 
 
 def parse_control_files(data_dir, ids):
-    # regex to ignore comments on a line
-    line_re = re.compile("(.*)#")
-
     # map to hold extract control info
     swarm_control_info = {}
 
@@ -61,15 +67,10 @@ def parse_control_files(data_dir, ids):
         for cf in control_files:
             # open the control file
             with open(cf, "r") as f:
-                # strip comments
-                lines = f.read().splitlines()
-                stripped_lines = []
-                for l in lines:
-                    m = line_re.match(l)
-                    if m:
-                        stripped_lines.append(m.group(1).strip())
-                    else:
-                        stripped_lines.append(l.strip())
+                # strip comments - everything from the last '#' on a line is dropped
+                stripped_lines = [
+                    l.rsplit("#", 1)[0].strip() for l in f.read().splitlines()
+                ]
 
                 # read in required data
                 parsed_date = datetime.strptime(stripped_lines[0], "%y %m %d %H %M")
@@ -104,16 +105,24 @@ def parse_trajectory_files(data_dir, ids, control_info):
             ci = control_info[id][day - 1]
 
             # load csv
-            tdf = pd.read_csv(tf, names=["point_id", "x", "y", "altitude"])
+            tdf = pd.read_csv(
+                tf, names=TRAJECTORY_COLUMNS, dtype=TRAJECTORY_DTYPES, engine="c"
+            )
 
             # get rid of the end marker
             tdf = tdf[tdf["point_id"] != "END"]
             # ID field consists of a track number in the first digit, and a record
             # number in the remaining.  They need to be split out.
-            tdf["track"] = tdf["point_id"].str.strip().str[0]
-            tdf["point_id"] = tdf["point_id"].str.strip().str[1:]
+            point_ids = tdf["point_id"].str.strip()
+            tdf["track"] = point_ids.str[0]
+            tdf["point_id"] = point_ids.str[1:]
             tdf["date"] = ci.date
 
+            # order the day's points - grouping keeps this order within each track, so
+            # only the days need ordering once the tracks are composed
+            if not tdf["point_id"].is_monotonic_increasing:
+                tdf = tdf.sort_values("point_id", kind="mergesort")
+
             # Group by the track ID number.
             track_groups = tdf.groupby("track")
 
@@ -121,19 +130,21 @@ def parse_trajectory_files(data_dir, ids, control_info):
             for track, frame in track_groups:
                 if track not in trajectory_data:
                     trajectory_data[track] = []
-                trajectory_data[track].append(frame)
+                trajectory_data[track].append((ci.date, frame))
 
         # Compose the data for each track into a single df spanning multiple days
         for _, d in trajectory_data.items():
-            tdf = pd.concat(d)
+            d.sort(key=lambda day_frame: day_frame[0])
+            tdf = pd.concat([frame for _, frame in d])
             # recompute index/point ids to enmerate final point orderings
-            tdf = tdf.sort_values(["date", "point_id"])
             tdf = tdf.reset_index(drop=True)
-            tdf["point_id"] = tdf.index
 
             # write the swarm id and the starting altitude in for each
-            tdf["swarm_id"] = id
-            tdf["altitude_id"] = int(tdf.loc[0, "altitude"])
+            tdf = tdf.assign(
+                point_id=tdf.index,
+                swarm_id=id,
+                altitude_id=int(tdf["altitude"].iat[0]),
+            )
 
             # save out the final dataframe
             trajectories.append(tdf)
@@ -141,115 +152,126 @@ def parse_trajectory_files(data_dir, ids, control_info):
     return trajectories
 
 
-def geohash_cell_size(level):
-    bounds = geohash.bbox("0" * level)
-    return (bounds["e"] - bounds["w"], bounds["n"] - bounds["s"])
+def get_cell_index(p, cell_size):
+    return int(math.floor(p / cell_size))
 
 
-def get_cell_loc(p, cell_size):
-    idx = int(math.floor(p / cell_size))
-    return cell_size * idx
+def line_to_cells(x0, y0, x1, y1, cell_x_size, cell_y_size):
+    # effectively a ray tracing operation over a rectangular grid - the (x, y) indices of
+    # the cells crossed are stepped through as integers, so no error accumulates along
+    # the line
 
-
-def line_to_geohashes(x0, y0, x1, y1, level):
-    # effectively a ray tracing operation over a rectangular grid
-
-    line_geohashes = set()
-
-    cell_x_size, cell_y_size = geohash_cell_size(level)
-
-    # compute the coordinate of the LL corner of each cell
-    x0_cell_loc = get_cell_loc(x0, cell_x_size)
-    y0_cell_loc = get_cell_loc(y0, cell_y_size)
-    x1_cell_loc = get_cell_loc(x1, cell_x_size)
-    y1_cell_loc = get_cell_loc(y1, cell_y_size)
+    # compute the index of the cell containing each endpoint
+    i = get_cell_index(x0, cell_x_size)
+    j = get_cell_index(y0, cell_y_size)
+    i1 = get_cell_index(x1, cell_x_size)
+    j1 = get_cell_index(y1, cell_y_size)
 
     # compute the difference between the endpoints
     dx = math.fabs(x1 - x0)
     dy = math.fabs(y1 - y0)
 
-    dt_dx = 1.0 / dx if dx != 0.0 else 0.0
-    dt_dy = 1.0 / dy if dy != 0.0 else 0.0
-
-    x = x0_cell_loc
-    y = y0_cell_loc
-
-    num_steps = 1
-    x_inc = 0.0
-    y_inc = 0.0
-    t_next_horiz = 0.0
-    t_next_vert = 0.0
+    # distance along the line (as a fraction of its length) between successive cell
+    # boundaries on each axis, and to the first boundary crossed on each axis - lines
+    # parallel to an axis never cross its boundaries
+    t_delta_horiz = cell_x_size / dx if dx != 0.0 else math.inf
+    t_delta_vert = cell_y_size / dy if dy != 0.0 else math.inf
 
     if dx == 0.0:
-        x_inc = 0.0
-        t_next_horiz = dt_dx * cell_x_size
+        i_inc = 0
+        t_next_horiz = math.inf
     elif x1 > x0:
-        x_inc = cell_x_size
-        # number of horizontal intersections
-        num_steps += (x1_cell_loc - x) / cell_x_size
-        t_next_horiz = (x0_cell_loc + cell_x_size - x0) * dt_dx
+        i_inc = 1
+        t_next_horiz = ((i + 1) * cell_x_size - x0) / dx
     else:
-        x_inc = -cell_x_size
-        # number of horizontal intersections
-        num_steps += (x - x1_cell_loc) / cell_x_size
-        t_next_horiz = (x0 - x0_cell_loc) * dt_dx
+        i_inc = -1
+        t_next_horiz = (x0 - i * cell_x_size) / dx
 
     if dy == 0.0:
-        y_inc = 0
-        t_next_vert = dt_dy * cell_y_size
+        j_inc = 0
+        t_next_vert = math.inf
     elif y1 > y0:
-        y_inc = cell_y_size
-        # number of vertical intersections
-        num_steps += (y1_cell_loc - y) / cell_y_size
-        t_next_vert = (y0_cell_loc + cell_y_size - y0) * dt_dy
+        j_inc = 1
+        t_next_vert = ((j + 1) * cell_y_size - y0) / dy
     else:
-        y_inc = -cell_y_size
-        # number of vertical intersections
-        num_steps += (y - y1_cell_loc) / cell_y_size
-        t_next_vert = (y0 - y0_cell_loc) * dt_dy
+        j_inc = -1
+        t_next_vert = (y0 - j * cell_y_size) / dy
 
-    for n in range(int(num_steps), 0, -1):
-        line_geohashes.add(geohash.encode(y, x, level))
+    # one step per horizontal / vertical intersection, plus the starting cell
+    num_steps = 1 + abs(i1 - i) + abs(j1 - j)
+
+    cells = []
+    for _ in range(num_steps):
+        cells.append((i, j))
 
         if t_next_vert < t_next_horiz:
-            y += y_inc
-            t_next_vert += dt_dy * cell_y_size
+            j += j_inc
+            t_next_vert += t_delta_vert
         else:
-            x += x_inc
-            t_next_horiz += dt_dx * cell_x_size
+            i += i_inc
+            t_next_horiz += t_delta_horiz
+
+    return cells
 
-    return line_geohashes
+
+def cells_to_geohashes(cells, cell_x_size, cell_y_size, level):
+    # cell indices are packed into a single unsigned key each so that duplicates are
+    # dropped in one vectorized pass
+    cells = np.array(list(cells), dtype=np.int64).reshape(-1, 2) + CELL_INDEX_OFFSET
+    keys = np.unique(
+        (cells[:, 0].astype(np.uint64) << np.uint64(32)) | cells[:, 1].astype(np.uint64)
+    )
+    i = (keys >> np.uint64(32)).astype(np.int64) - CELL_INDEX_OFFSET
+    j = (keys & np.uint64(0xFFFFFFFF)).astype(np.int64) - CELL_INDEX_OFFSET
+
+    # cells are encoded at their centre so that rounding can't place a cell's point in
+    # its neighbour
+    return helpers.encode_geohashes(
+        (j + 0.5) * cell_y_size, (i + 0.5) * cell_x_size, level
+    )
+
+
+def line_to_geohashes(x0, y0, x1, y1, level):
+    cell_x_size, cell_y_size = helpers.geohash_cell_size(level)
+    cells = line_to_cells(x0, y0, x1, y1, cell_x_size, cell_y_size)
+    return set(cells_to_geohashes(cells, cell_x_size, cell_y_size, level))
 
 
 def trajectories_to_df(trajectories, level):
-    trajectory_dataframes = []
+    # the output columns are accumulated across all trajectories, and the dataframe is
+    # built once at the end
+    trajectory_columns = {
+        "swarm_id": [],
+        "altitude_id": [],
+        "date": [],
+        "geohash": [],
+        "bounds": [],
+    }
+
+    cell_x_size, cell_y_size = helpers.geohash_cell_size(level)
 
     # loop over the trajectory dataframes and extract the flight paths as a list of x,y coords
     for tdf in trajectories:
-        points = zip(tdf["x"], tdf["y"])
-        last_p = next(points)
-        geohashes = set()
-
-        for p in points:
-            geohashes = geohashes.union(
-                line_to_geohashes(p[0], p[1], last_p[0], last_p[1], level)
-            )
-            last_p = p
-        geohashes = list(geohashes)
-        bounds = [helpers.geohash_to_array_str(gh) for gh in geohashes]
-
-        gdf = pd.DataFrame(
-            columns=["swarm_id", "altitude_id", "date", "geohash", "bounds"]
+        xs = tdf["x"].to_numpy(dtype=float).tolist()
+        ys = tdf["y"].to_numpy(dtype=float).tolist()
+
+        # collect the cells crossed by each segment, and only dedupe and encode the cells
+        # once the whole path has been traced
+        cells = []
+        for x0, y0, x1, y1 in zip(xs[1:], ys[1:], xs, ys):
+            cells.extend(line_to_cells(x0, y0, x1, y1, cell_x_size, cell_y_size))
+        geohashes = cells_to_geohashes(cells, cell_x_size, cell_y_size, level)
+
+        trajectory_columns["geohash"].extend(geohashes)
+        trajectory_columns["bounds"].extend(
+            helpers.geohash_to_array_str(gh) for gh in geohashes
         )
-        gdf["geohash"] = geohashes
-        gdf["bounds"] = bounds
-        gdf["swarm_id"] = tdf["swarm_id"]
-        gdf["altitude_id"] = tdf["altitude_id"]
-        gdf["date"] = tdf["date"]
-
-        trajectory_dataframes.append(gdf)
+        # the trajectory values are aligned to the geohashes by row index
+        rows = pd.RangeIndex(len(geohashes))
+        for column in ["swarm_id", "altitude_id", "date"]:
+            trajectory_columns[column].extend(tdf[column].reindex(rows).tolist())
 
-    return pd.concat(trajectory_dataframes)
+    return pd.DataFrame(trajectory_columns)
 
 
 def debug():
@@ -284,7 +306,7 @@ def debug():
 
     pdf = pd.concat([pdf, edf])
 
-    xz, yz = geohash_cell_size(5)
+    xz, yz = helpers.geohash_cell_size(5)
     f1 = px.scatter(pdf, x="x", y="y", color="source")
     f1.update_yaxes(dtick=yz)
     f1.update_xaxes(dtick=xz)
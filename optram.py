@@ -4,8 +4,9 @@ import zipfile
 from tqdm import tqdm
 import os
 import random
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 from zipfile import ZipFile
 
 import numpy as np
@@ -14,28 +15,18 @@ import statsmodels.formula.api as smf
 from ee.ee_number import Number
 from tifffile import imread
 
+# bands read to calculate the OPTRAM variables - red (B4), NIR (B8) and SWIR (B12)
+OPTRAM_BANDS = ("B4", "B8", "B12")
 
-def zip2numpy_sentinel(inpath: str) -> np.ndarray:
-    """- parses zip file and combines all tiffs into ndarray"""
-    inpath = inpath.strip()
-    ghash = os.path.basename(inpath).split('.')[0]
-    ghash, _ = ghash.split('_')
-    with ZipFile(inpath) as handle:
-        tile = np.stack([
-            imread(handle.open(f'{ghash}.B1.tif')),
-            imread(handle.open(f'{ghash}.B2.tif')),
-            imread(handle.open(f'{ghash}.B3.tif')),
-            imread(handle.open(f'{ghash}.B4.tif')),
-            imread(handle.open(f'{ghash}.B5.tif')),
-            imread(handle.open(f'{ghash}.B6.tif')),
-            imread(handle.open(f'{ghash}.B7.tif')),
-            imread(handle.open(f'{ghash}.B8.tif')),
-            imread(handle.open(f'{ghash}.B8A.tif')),
-            imread(handle.open(f'{ghash}.B9.tif')),
-            imread(handle.open(f'{ghash}.B11.tif')),
-            imread(handle.open(f'{ghash}.B12.tif')),
-            imread(handle.open(f'{ghash}.QA60.tif'))
-        ])
+# maximum number of pixels the quantile regressions are fit on
+MAX_FIT_SAMPLES = 200_000
+
+
+def zip2numpy_sentinel_bands(inpath: str, bands: Tuple[str, ...]) -> np.ndarray:
+    """- parses zip file and combines the tiffs of the given bands into ndarray"""
+    ghash = parse_geo_hash(inpath)
+    with ZipFile(inpath.strip()) as handle:
+        tile = np.stack([imread(handle.open(f'{ghash}.{band}.tif')) for band in bands])
         tile = tile.astype(np.int32)
 
     return tile
@@ -57,19 +48,16 @@ def build_spatial_hash(inpath: str, level_of_precision: Number) -> Dict[str, Lis
         spatial_map[geo_hash].append(file)
     return spatial_map
 
-def get_NDVI(arr: np.ndarray) -> np.ndarray:
+def get_NDVI(NIR: np.ndarray, RED: np.ndarray) -> np.ndarray:
     """- returns an NDVI image created from B8 AND B4"""
-    NIR = arr[7] #B8
-    RED = arr[3] #B4
     return ((NIR - RED)/(NIR + RED))
 
 
-def get_STR(arr: np.ndarray) -> np.ndarray:
+def get_STR(RSWIR: np.ndarray) -> np.ndarray:
     """
         - eq. 7 in paper \n
         - returns surface reflectance from B12
     """
-    RSWIR = arr[11] #B12
     STR   = ((1-RSWIR)**2)/(2*RSWIR)
     return STR
 
@@ -82,29 +70,43 @@ def fit_quanmod(df: pd.DataFrame, q: Number) -> List[float]:
     res = mod.fit(q=q)
     return [res.params['Intercept'], res.params['NDVI']]
 
+def process_tile(file: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+        - reads only the bands needed from a tile and computes its NDVI and STR
+        - returns only the pixels that survive the outlier filter, or None for empty tiles
+    """
+    img = zip2numpy_sentinel_bands(file, OPTRAM_BANDS)
+    if img.sum() == 0:
+        return None
+    # convert S2 level 1C image to Top-of-atmosphere scale (sec 3.2)
+    img = img*0.0001
+    RED, NIR, RSWIR = img
+    NDVI = get_NDVI(NIR, RED).flatten()
+    STR = get_STR(RSWIR).flatten()
+
+    # filter likely outliers
+    idx = (STR < 20.) & (NDVI > 0)
+    return NDVI[idx], STR[idx]
+
 def load_images(files: List[str]) -> Tuple[pd.DataFrame, Number]:
     NDVI, STR = [], []
     print("Loading images into memory", end="\r")
-    # loop through each file
-    for i in range(len(files)):
-        img = zip2numpy_sentinel(files[i])
-        if img.sum() == 0:
-            continue
-        # convert S2 level 1C image to Top-of-atmosphere scale (sec 3.2)
-        img = img*0.0001
-        NDVI.append(get_NDVI(img).flatten())
-        STR.append(get_STR(img).flatten())
-        
-    # this seems redundant, instead of appending above it could be concatenate
+    # tiles are read and processed across a thread pool, as the zip and tiff decoding
+    # release the GIL - results are returned in file order
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for result in executor.map(process_tile, files):
+            if result is None:
+                continue
+            NDVI.append(result[0])
+            STR.append(result[1])
+
     NDVI = np.concatenate(NDVI, axis=0)
     STR  = np.concatenate(STR, axis=0)
 
-    # filter likely outliers
-    idx = np.where(STR <  20.)[0]
-    NDVI, STR = NDVI[idx], STR[idx]
-
-    idx = np.where(NDVI >  0)[0]
-    NDVI, STR = NDVI[idx], STR[idx]
+    # fit on a uniform (reproducible) sample of the pixels rather than all of them
+    if len(NDVI) > MAX_FIT_SAMPLES:
+        idx = np.random.default_rng(0).choice(len(NDVI), MAX_FIT_SAMPLES, replace=False)
+        NDVI, STR = NDVI[idx], STR[idx]
 
     return pd.DataFrame(zip(NDVI,STR), columns=['NDVI', 'STR']), len(files)
 
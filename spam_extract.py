@@ -1,9 +1,7 @@
 import argparse
+import numpy as np
 import pandas as pd
-from shapely import geometry
 import helpers
-import json
-from polygon_geohasher import polygon_geohasher
 from tqdm import tqdm
 
 CELL_SIZE_X = 360.0 / 4320.0
@@ -24,6 +22,37 @@ def parse_args():
     return parser.parse_args()
 
 
+def cells_to_geohashes(xs, ys, level):
+    # SPAM cells and geohashes both lie on regular grids, so the geohashes intersecting
+    # each cell are found directly from the range of geohash grid indices the cell spans.
+    # As with a polygon intersection test, geohashes that only touch a cell's edge are
+    # included.  Returns the row index of the cell for each geohash, and the geohashes.
+    gh_x_size, gh_y_size = helpers.geohash_cell_size(level)
+    i_lo = np.ceil((xs - CELL_SIZE_X / 2) / gh_x_size).astype(np.int64) - 1
+    i_hi = np.floor((xs + CELL_SIZE_X / 2) / gh_x_size).astype(np.int64)
+    j_lo = np.ceil((ys - CELL_SIZE_Y / 2) / gh_y_size).astype(np.int64) - 1
+    j_hi = np.floor((ys + CELL_SIZE_Y / 2) / gh_y_size).astype(np.int64)
+
+    # enumerate the grid offsets up to the largest span of any cell, keeping those that
+    # fall within each cell's own span
+    di, dj = np.meshgrid(
+        np.arange((i_hi - i_lo).max(initial=0) + 1),
+        np.arange((j_hi - j_lo).max(initial=0) + 1),
+        indexing="ij",
+    )
+    rows = np.repeat(np.arange(len(xs)), di.size)
+    i = np.tile(di.ravel(), len(xs)) + i_lo[rows]
+    j = np.tile(dj.ravel(), len(xs)) + j_lo[rows]
+    in_cell = (i <= i_hi[rows]) & (j <= j_hi[rows])
+    rows, i, j = rows[in_cell], i[in_cell], j[in_cell]
+
+    # geohashes are encoded from their centres
+    geohashes = helpers.encode_geohashes(
+        (j + 0.5) * gh_y_size, (i + 0.5) * gh_x_size, level
+    )
+    return rows, geohashes
+
+
 def main():
     args = parse_args()
 
@@ -36,7 +65,7 @@ def main():
     geohashes_aoi = set()
     if args.coverage_file is not None:
         # loading coverage polygon from geo json file
-        coverage_geojson = json.load(open(args.coverage_file))
+        coverage_geojson = helpers.load_json(args.coverage_file)
 
         # generate geohashes covered by the AoI
         geohashes_aoi = helpers.geohashes_from_geojson_poly(
@@ -50,50 +79,37 @@ def main():
     df = df[(["x", "y"] + args.crop_columns)]
     df = df.reset_index()
 
-    # loop over the x, y which are the cell centroids, and generate a bounding box based on
-    # the cell size (taken from the associated geotiff resolution)
-    print('Converting points to bounds...')
-    centroids = zip(df["x"], df["y"])
-    bounds = [
-        geometry.box(
-            c[0] - CELL_SIZE_X / 2,
-            c[1] - CELL_SIZE_Y / 2,
-            c[0] + CELL_SIZE_X / 2,
-            c[1] + CELL_SIZE_Y / 2,
-        )
-        for c in tqdm(centroids)
-    ]
-
-    # loop through the bounds we've created and intersect each with the intended geohash grid
-    print('Converting bounds to geohashes...')
-    geohashes = [
-        polygon_geohasher.polygon_to_geohashes(
-            b, precision=args.geohash_level, inner=False
-        )
-        for b in tqdm(bounds)
-    ]
+    # the x, y are the cell centroids, with the cell size taken from the associated geotiff
+    # resolution - intersect each cell with the intended geohash grid
+    print('Converting cells to geohashes...')
+    cells, geohashes = cells_to_geohashes(
+        df["x"].to_numpy(dtype=float), df["y"].to_numpy(dtype=float), args.geohash_level
+    )
 
-    # flatten  gh set for each cell preserving index - no clean way to do this in pandas
-    flattened_gh = []
+    # flatten gh for each cell preserving index, clipping to the AoI if one was supplied
     print('Clipping geohashes to AoI...')
-    for idx, gh_set in tqdm(enumerate(geohashes)):
-        for gh in gh_set:
-            if (len(geohashes_aoi) > 0 and gh in geohashes_aoi) or len(
-                geohashes_aoi
-            ) is 0:
-                bounds_str = helpers.geohash_to_array_str(gh)
-                flattened_gh.append((idx, gh, bounds_str))
+    flattened_gh = zip(cells.tolist(), geohashes)
+    if len(geohashes_aoi) > 0:
+        geohashes_aoi = frozenset(geohashes_aoi)
+        flattened_gh = [(idx, gh) for idx, gh in flattened_gh if gh in geohashes_aoi]
 
     # store as a dataframe with any geohashes that were part of 2 cells reduced to 1
     # a better implementation of this would take the value of both cells into  account and
     # compute a final adjusted value for the given geohash
     print('Genering output csv...')
-    geohash_df = pd.DataFrame(flattened_gh, columns=["cell", "geohash", "bounds"])
+    geohash_df = pd.DataFrame(flattened_gh, columns=["cell", "geohash"])
     geohash_df = geohash_df.drop_duplicates(subset="geohash", keep="first")
     geohash_df = geohash_df.set_index("cell")
 
-    joined = pd.merge(df, geohash_df, left_index=True, right_index=True)
-    joined = joined.drop(columns=["x", "y", "index"])
+    # bounds are only generated for the geohashes that are kept
+    geohash_df["bounds"] = [
+        helpers.geohash_to_array_str(gh) for gh in tqdm(geohash_df["geohash"])
+    ]
+
+    # each geohash row takes the crop values of its cell by direct index lookup
+    joined = df.loc[geohash_df.index, args.crop_columns].reset_index(drop=True)
+    joined["geohash"] = geohash_df["geohash"].to_numpy()
+    joined["bounds"] = geohash_df["bounds"].to_numpy()
 
     joined.to_csv(args.output_file, index=False)
 